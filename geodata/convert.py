@@ -25,7 +25,6 @@ from __future__ import absolute_import
 import datetime as dt
 import logging
 from operator import itemgetter
-from six import string_types
 import xarray as xr
 import numpy as np
 
@@ -79,7 +78,7 @@ def convert_cutout(cutout, convert_func, show_progress=True, **convert_kwds):
 
 	yearmonths = cutout.coords['year-month'].to_index()
 
-	if isinstance(show_progress, string_types):
+	if isinstance(show_progress, str):
 		prefix = show_progress
 	else:
 		func_name = (convert_func.__name__[len('convert_'):]
@@ -394,7 +393,7 @@ def wind(cutout, turbine, smooth=False, **params):
 		1074 – 1088. doi:10.1016/j.energy.2015.09.071
 	"""
 
-	if isinstance(turbine, string_types):
+	if isinstance(turbine, str):
 		turbine = get_windturbineconfig(turbine)
 
 	if smooth:
@@ -426,7 +425,7 @@ def windspd(cutout, **params):
 
 	if 'turbine' in params:
 		turbine = params.pop('turbine')
-		if isinstance(turbine, string_types):
+		if isinstance(turbine, str):
 			turbine = get_windturbineconfig(turbine)
 		else:
 			raise ValueError(f"Turbine ({turbine}) not found.")
@@ -466,7 +465,7 @@ def windwpd(cutout, **params):
 
 	if 'turbine' in params:
 		turbine = params.pop('turbine')
-		if isinstance(turbine, string_types):
+		if isinstance(turbine, str):
 			turbine = get_windturbineconfig(turbine)
 		else:
 			raise ValueError(f"Turbine ({turbine}) not found.")
@@ -538,7 +537,7 @@ def pv(cutout, panel, orientation, clearsky_model=None, **params):
 		Eurosun (ISES Europe Solar Congress).
 	'''
 
-	if isinstance(panel, string_types):
+	if isinstance(panel, str):
 		panel = get_solarpanelconfig(panel)
 	if not callable(orientation):
 		orientation = get_orientation(orientation)
@@ -33,7 +33,6 @@ import shapely
 import xarray as xr
 import numpy as np
 from shapely.geometry import box
-from six import iteritems
 from . import config #pylint: disable=E0611
 
 from .convert import (
@@ -211,7 +210,7 @@ class Cutout:
 		meta = self.meta
 		if meta.attrs.get('view', {}):
 			view = {}
-			for name, value in iteritems(meta.attrs.get('view', {})):
+			for name, value in meta.attrs.get('view', {}).items():
 				view.update({name: [value.start, value.stop]})
 			meta.attrs['view'] = str(view)
 		return meta
@@ -239,16 +239,16 @@ def prepare_month_era5(fn, year, month, xs, ys):
 
 	if not os.path.isfile(fn):
 		return None
-	with xr.open_dataset(fn) as ds:
+	with xr.open_dataset(fn, chunks={'time': 24}) as ds:
 		logger.info('Opening %s', fn)
 		ds = _rename_and_clean_coords(ds)
 		# ds = _add_height(ds)
 		ds = subset_x_y_era5(ds, xs, ys)
 
 		ds = ds.rename({'fdir': 'influx_direct', 'tisr': 'influx_toa'})
-		with np.errstate(divide='ignore', invalid='ignore'):
-			ds['albedo'] = (((ds['ssrd'] - ds['ssr'])/ds['ssrd']).fillna(0.)
-							.assign_attrs(units='(0 - 1)', long_name='Albedo'))
+		# Mask zero downward radiation (night) before dividing, the lazy division runs outside any np.errstate
+		ds['albedo'] = (((ds['ssrd'] - ds['ssr'])/ds['ssrd'].where(ds['ssrd'] != 0)).fillna(0.)
+						.assign_attrs(units='(0 - 1)', long_name='Albedo'))
 		ds['influx_diffuse'] = ((ds['ssrd'] - ds['influx_direct'])
 								.assign_attrs(units='J m**-2',
 											long_name='Surface diffuse solar radiation downwards'))
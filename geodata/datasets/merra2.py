@@ -29,7 +29,6 @@ import requests
 from requests.exceptions import HTTPError
 import numpy as np
 import xarray as xr
-from six.moves import range #type: ignore
 
 from ..config import merra2_dir
 logger = logging.getLogger(__name__)
@@ -194,7 +193,7 @@ def prepare_meta_merra2(xs, ys, year, month, template, module, **params):
 def prepare_month_surface_flux(fn, year, month, xs, ys):
 	if not os.path.isfile(fn):
 		return None
-	with xr.open_dataset(fn) as ds:
+	with xr.open_dataset(fn, chunks={'time': 24}) as ds:
 		logger.info('Opening %s', fn)
 		# logger.info("Cutout dims: %s", ds.dims)
 		# logger.info("Cutout coords: %s", ds.coords)
@@ -229,7 +228,7 @@ def prepare_month_surface_flux(fn, year, month, xs, ys):
 def prepare_month_aerosol(fn, year, month, xs, ys):
 	if not os.path.isfile(fn):
 		return None
-	with xr.open_dataset(fn) as ds:
+	with xr.open_dataset(fn, chunks={'time': 24}) as ds:
 		logger.info('Opening %s', fn)
 		ds = _rename_and_clean_coords(ds)
 		ds = subset_x_y_merra2(ds, xs, ys)
@@ -238,7 +237,7 @@ def prepare_month_aerosol(fn, year, month, xs, ys):
 def prepare_dailymeans_surface_flux(fn, year, month, xs, ys):
 	if not os.path.isfile(fn):
 		return None
-	with xr.open_dataset(fn) as ds:
+	with xr.open_dataset(fn, chunks={'time': 24}) as ds:
 		logger.info('Opening %s', fn)
 		# logger.info("Cutout dims: %s", ds.dims)
 		# logger.info("Cutout coords: %s", ds.coords)
@@ -271,7 +270,7 @@ def prepare_dailymeans_surface_flux(fn, year, month, xs, ys):
 def prepare_slv_radiation(fn, year, month, xs, ys):
 	if not os.path.isfile(fn):
 		return None
-	with xr.open_dataset(fn) as ds:
+	with xr.open_dataset(fn, chunks={'time': 24}) as ds:
 		logger.info('Opening %s', fn)
 		# logger.info("Cutout dims: %s", ds.dims)
 		# logger.info("Cutout coords: %s", ds.coords)
@@ -24,55 +24,207 @@ from __future__ import absolute_import
 
 import os
 import logging
-import tempfile
 import shutil
-import subprocess
 import calendar
 from glob import glob
+from collections import defaultdict, Counter
+from functools import lru_cache
 from multiprocessing import Pool
 import pandas as pd
 import numpy as np
 import xarray as xr
-from six.moves import map #type: ignore
+import rasterio as ras
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, Resampling
 import dask
 
 
 logger = logging.getLogger(__name__)
 
-def cutout_do_task(task, write_to_file=True):
-	task = task.copy()
-	prepare_func = task.pop('prepare_func')
-	if write_to_file:
-		datasetfns = task.pop('datasetfns')
+try:
+	import h5py #pylint: disable=unused-import
+	import h5netcdf #pylint: disable=unused-import
+	has_h5netcdf = True
+except ImportError:
+	has_h5netcdf = False
+
+def _netcdf_encoding(ds, time_chunk=24):
+	# Light zlib compression for the cutout files, chunked in blocks of `time_chunk` time steps with
+	#	full x/y slices to favour reading time ranges
+	#	Keeps the packing (dtype, scale_factor, ...) of variables read from the source files
+	encoding = {}
+	for name, da in ds.data_vars.items():
+		if da.ndim == 0 or da.dtype.kind not in 'biuf':
+			continue
+		var_encoding = {k: v for k, v in da.encoding.items()
+						if k in ('dtype', 'scale_factor', 'add_offset', '_FillValue', 'missing_value')}
+		var_encoding.update(zlib=True, complevel=1, shuffle=True,
+							chunksizes=tuple(min(time_chunk, n) if d == 'time' else n
+											 for d, n in zip(da.dims, da.shape)))
+		if 0 in da.shape:
+			# Empty dimensions cannot be chunked
+			del var_encoding['chunksizes']
+		encoding[name] = var_encoding
+	return encoding
+
+class CutoutTask:
+	# A single preparation task: prepare_func(fn, year, month, xs, ys) for one source file,
+	#	written to datasetfn. Built from the dicts returned by the dataset tasks_func.
+	#	Slotted and pickled as a plain tuple to keep it cheap to send to the workers.
+	__slots__ = ('prepare_func', 'xs', 'ys', 'year', 'month', 'fn', 'datasetfn')
+
+	def __init__(self, *, prepare_func, xs, ys, year, month, fn, datasetfn=None):
+		self.prepare_func = prepare_func
+		self.xs = xs
+		self.ys = ys
+		self.year = year
+		self.month = month
+		self.fn = fn
+		self.datasetfn = datasetfn
+
+	def __getstate__(self):
+		return tuple(getattr(self, name) for name in self.__slots__)
+
+	def __setstate__(self, state):
+		for name, value in zip(self.__slots__, state):
+			setattr(self, name, value)
+
+	@property
+	def yearmonth(self):
+		return (self.year, self.month)
+
+def cutout_do_task(task, write_to_file=True, height=None):
+	# height: gebco heights to add, only given for the single task of a yearmonth
+	prepare_func = task.prepare_func
 
 	# Force dask to use just one thread (to save memory)
 	with dask.config.set(scheduler='single-threaded'):
 		try:
-			data = prepare_func(**task)
+			data = prepare_func(fn=task.fn, year=task.year, month=task.month, xs=task.xs, ys=task.ys)
 			if data is None:
 				data = []
 
 			if write_to_file:
+				# Keep track of the written files, so they can be merged without scanning cutout_dir
+				written = []
 				for yearmonth, ds in data:
 					if ds is None:
 						continue
-					fn = datasetfns[yearmonth] #type: ignore
-					logger.debug("Writing to %s", os.path.basename(fn))
-					ds.to_netcdf(fn)
+					if height is not None:
+						ds['height'] = height
+					logger.debug("Writing to %s", os.path.basename(task.datasetfn))
+					ds.to_netcdf(task.datasetfn, encoding=_netcdf_encoding(ds))
 					logger.debug("Write variable(s) %s to %s generated by %s",
 								", ".join(ds.data_vars),
-								os.path.basename(fn),
+								os.path.basename(task.datasetfn),
 								prepare_func.__name__)
+					written.append((yearmonth, task.datasetfn))
+				return written
 			else:
-				return data
+				# The datasets are lazy and outlive the `with` block of prepare_func, xarray reopens
+				#	the closed source file when they are computed
+				return list(data)
 		except Exception as e:
 			logger.exception("Exception occured in the task with prepare_func `%s`: %s",
 							prepare_func.__name__, e.args[0])
 			raise e
 
-def cutout_prepare(cutout, overwrite=False, nprocesses=None, gebco_height=False):
+def _cutout_do_indexed_task(args):
+	# Run a task for the pool/client: args (i, task, height), returns (i, written)
+	i, task, height = args
+	return i, cutout_do_task(task, height=height)
+
+def _merge_one_yearmonth(args):
+	# Merge the task files of one yearmonth into its compound file
+	#	args: (fn, fns, height), with height None unless gebco heights are added
+	fn, fns, height = args
+	if len(fns) == 1 and height is None:
+		# Just a single file. Simply rename
+		os.rename(fns[0], fn)
+	else:
+		# Multiple files for yearmonth
+		#  Task files share the same variables and grid and are in time order, so concatenate
+		#  them along time directly, without comparing or aligning the shared variables and x/y indexes
+		#  chunks={} keeps the on-disk chunks as dask chunks, so the merged file is streamed chunk by chunk
+		#  The task files are NetCDF4/HDF5, which h5netcdf (if installed) reads without the netCDF4 C library
+		with xr.open_mfdataset(fns, engine='h5netcdf' if has_h5netcdf else None,
+							   combine='nested', concat_dim='time', chunks={}, parallel=False,
+							   data_vars='minimal', coords='minimal', compat='override', join='override') as ds:
+			if height is not None:
+				ds['height'] = height
+			ds.to_netcdf(fn, encoding=_netcdf_encoding(ds))
+
+		for tfn in fns:
+			os.unlink(tfn)
+	logger.debug("Completed files %s", os.path.basename(fn))
+
+def _run_tasks(tasks, tasks_per_yearmonth, datasetfn, height, *, nprocesses=None, client=None):
+	# Run the tasks on a multiprocessing pool (or the dask client), and merge the files of a yearmonth
+	#	into its compound file as soon as all of its tasks have finished, while the remaining tasks keep running
+	# Single tasks of a yearmonth add the gebco heights themselves, the others get them when merged
+	task_args = [(i, t, height if tasks_per_yearmonth[t.yearmonth] == 1 else None)
+				 for i, t in enumerate(tasks)]
+
+	pools = []
+	futures = []
+	try:
+		if client is None:
+			# Recycle workers after a few tasks to release the memory and file handles accumulated by xarray/dask
+			pools.append(Pool(processes=nprocesses, maxtasksperchild=8))
+			# One task per chunk, so every result is handed back as soon as its task is done
+			completed = pools[0].imap_unordered(_cutout_do_indexed_task, task_args)
+		else:
+			from dask.distributed import as_completed # pylint: disable=import-outside-toplevel
+			futures = client.map(_cutout_do_indexed_task, task_args, pure=False)
+			completed = (future.result() for future in as_completed(futures))
+
+		pending = tasks_per_yearmonth.copy()
+		written_fns = defaultdict(list)
+		merges = []
+		for i, written in completed:
+			ym = tasks[i].yearmonth
+			written_fns[ym] += [(i, tfn) for _, tfn in written]
+			pending[ym] -= 1
+			if pending[ym] == 0:
+				# files eg `201101-XX.nc` in task order
+				fns = [tfn for _, tfn in sorted(written_fns.pop(ym))]
+				if not fns:
+					raise FileNotFoundError(f"No data available for {os.path.basename(datasetfn(ym))}.")
+				if tasks_per_yearmonth[ym] == 1:
+					continue
+				merge_args = (datasetfn(ym), fns, height)
+				if client is None:
+					# Merges get their own pool: queued behind the tasks in the single FIFO queue
+					#	of the task pool, they would only start once all tasks have been handed out
+					if len(pools) == 1:
+						pools.append(Pool(processes=nprocesses))
+					merges.append(pools[1].apply_async(_merge_one_yearmonth, (merge_args,)))
+				else:
+					# Run ahead of the tasks still queued on the client
+					merges.append(client.submit(_merge_one_yearmonth, merge_args, pure=False, priority=1))
+					# Cancelled together with the tasks if a later task fails
+					futures.append(merges[-1])
+		if client is None:
+			for merge in merges:
+				merge.get()
+		else:
+			client.gather(merges)
+	except Exception:
+		# Cancel the pending client tasks before the files they write are purged
+		if client is not None:
+			client.cancel(futures)
+		raise
+	finally:
+		# Stop the pool workers, both when done and when interrupted (also on KeyboardInterrupt)
+		for pool in pools:
+			pool.terminate()
+
+def cutout_prepare(cutout, overwrite=False, nprocesses=None, gebco_height=False, client=None):
 	"""
 	Main preparation function
+
+	The tasks are run on a multiprocessing pool of `nprocesses` processes, or on the
+	dask.distributed `client` if one is given (nprocesses is then ignored).
 	"""
 	if cutout.prepared and not overwrite:
 		logger.info("The cutout is already prepared. If you want to recalculate it, supply an `overwrite=True` argument.")
@@ -123,7 +275,7 @@ def cutout_prepare(cutout, overwrite=False, nprocesses=None, gebco_height=False)
 	# Compute data and fill files
 	tasks = []
 
-	#for series in itervalues(cutout.weather_data_config[cutout.config]):
+	#for series in cutout.weather_data_config[cutout.config].values():
 		# dict of tasks w/structure (tasks_func, prepare_func)
 		# .. could be one task and prepare (eg prepare_month_era5)
 	series = cutout.weather_data_config[cutout.config]
@@ -132,54 +284,44 @@ def cutout_prepare(cutout, overwrite=False, nprocesses=None, gebco_height=False)
 
 	# form call to task_func (eg tasks_monthly_merra2)
 	# .. **series contains prepare_func
-	# returns: dict(prepare_func=prepare_func, xs=xs, ys=ys, year=year, month=month)
-	# .. or: dict(prepare_func=prepare_func, xs=xs, ys=ys, fn=next(glob...), engine=engine, yearmonth=ym)
-	tasks += tasks_func(xs=xs, ys=ys, yearmonths=yearmonths, **series)
+	# returns: dict(prepare_func=prepare_func, xs=xs, ys=ys, year=year, month=month, fn=fn.format(...))
+	# .. converted to CutoutTask
+	tasks += [CutoutTask(**t) for t in tasks_func(xs=xs, ys=ys, yearmonths=yearmonths, **series)]
+	tasks_per_yearmonth = Counter(t.yearmonth for t in tasks)
+
+	# Filenames are needed once per task and yearmonth; format them only once per yearmonth
+	datasetfn = lru_cache(maxsize=None)(cutout.datasetfn)
+	datasetfn_base_ext = {ym: os.path.splitext(datasetfn(ym)) for ym in tasks_per_yearmonth}
+
 	for i, t in enumerate(tasks):
-		def datasetfn_with_id(ym):
-			# returns a filename with incrementing id at end eg `201101-01.nc`
-			base, ext = os.path.splitext(cutout.datasetfn(ym))
-			return base + "-{}".format(i) + ext #pylint: disable=cell-var-from-loop
-		t['datasetfns'] = {ym: datasetfn_with_id(ym) for ym in yearmonths.tolist()}
+		# Each task writes only its own yearmonth
+		ym = t.yearmonth
+		if tasks_per_yearmonth[ym] == 1:
+			# Only task for the yearmonth: final filename eg `201101.nc`, written in a single pass
+			t.datasetfn = datasetfn(ym)
+		else:
+			# filename with incrementing id at end eg `201101-01.nc`, so the tasks of a yearmonth
+			#	(eg its days) run in parallel and are merged afterwards
+			base, ext = datasetfn_base_ext[ym]
+			t.datasetfn = base + "-{}".format(i) + ext
 
 	logger.info("%d tasks have been collected. Starting running them on %s.",
 				len(tasks),
-				("%d processes" % nprocesses)
+				("the dask client %s" % client)
+				if client is not None
+				else ("%d processes" % nprocesses)
 				if nprocesses is not None
 				else "all processors")
 
-	pool = Pool(processes=nprocesses)
+	height = cutout.meta['height'] if gebco_height else None
 	try:
-		pool.map(cutout_do_task, tasks)
+		_run_tasks(tasks, tasks_per_yearmonth, datasetfn, height, nprocesses=nprocesses, client=client)
 	except Exception as e:
-		pool.terminate()
 		logger.info("Preparation of cutout '%s' has been interrupted by an exception. "
 					"Purging the incomplete cutout_dir.",
 					cutout.name)
 		shutil.rmtree(cutout_dir)
 		raise e
-	pool.close()
-
-	logger.info("Merging variables into monthly compound files")
-
-	for fn in map(cutout.datasetfn, yearmonths.tolist()):
-		# Find all files with yearmonth prefix eg `201101-XX.nc`
-		base, ext = os.path.splitext(fn)
-		fns = glob(base + "-*" + ext)
-		if len(fns) == 1 and not gebco_height:
-			# Just a single file. Simply rename
-			os.rename(fns[0], fn)
-		else:
-			# Multiple files for yearmonth
-			#  open_mfdataset: auto-magically determines appropriate concat and merge of datasets
-			with xr.open_mfdataset(fns, combine='by_coords') as ds:
-				if gebco_height:
-					ds['height'] = cutout.meta['height']
-				ds.to_netcdf(fn)
-
-			for tfn in fns:
-				os.unlink(tfn)
-		logger.debug("Completed files %s", os.path.basename(fn))
 
 	logger.info("Cutout '%s' has been successfully prepared", cutout.name)
 	cutout.prepared = True
@@ -193,7 +335,7 @@ def cutout_produce_specific_dataseries(cutout, yearmonth, series_name):
 	tasks = tasks_func(xs=xs, ys=ys, yearmonths=[yearmonth], **series)
 
 	assert len(tasks) == 1
-	data = cutout_do_task(tasks[0], write_to_file=False)
+	data = cutout_do_task(CutoutTask(**tasks[0]), write_to_file=False)
 	assert len(data) == 1 and data[0][0] == yearmonth #type: ignore
 	return data[0][1] #type: ignore
 
@@ -227,28 +369,29 @@ def cutout_get_meta(cutout, xs, ys, years, months=None, **dataset_params):
 
 	# with metadata, load various parameters
 	meta_file_granularity = meta_kwds['file_granularity']
-	month_start = pd.Timestamp("{}-{}".format(years.stop, months.stop))
+	month_start = pd.Timestamp(year=years.stop, month=months.stop, day=1)
+	first_month_start = pd.Timestamp(year=years.start, month=months.start, day=1)
 	ds.coords["year"] = range(years.start, years.stop+1)
 	ds.coords["month"] = range(months.start, months.stop+1)
 
 	if meta_file_granularity == 'daily':
-		start, second, end = map(pd.Timestamp, ds.coords['time'].values[[0, 1, -1]])
+		start, second, end = pd.to_datetime(ds.coords['time'].values[[0, 1, -1]])
 		offset_start = (start - month_start)
 		offset_end = (end - (month_start + pd.offsets.MonthBegin()))
 		step = (second - start).components.hours
 		ds.coords["time"] = pd.date_range(
-			start=pd.Timestamp("{}-{}".format(years.start, months.start)) + offset_start,
+			start=first_month_start + offset_start,
 			end=(month_start + pd.offsets.MonthBegin() + offset_end),
 			freq='h' if step == 1 else ('%dh' % step))
 	elif meta_file_granularity == 'dailymeans':
 		ds.coords["time"] = pd.date_range(
-			start=pd.Timestamp("{}-{}-{}".format(years.start, months.start, 1)),
-			end=pd.Timestamp("{}-{}-{}".format(years.stop, months.stop, calendar.monthrange(years.stop, months.stop)[1])),
+			start=first_month_start,
+			end=pd.Timestamp(year=years.stop, month=months.stop, day=calendar.monthrange(years.stop, months.stop)[1]),
 			freq='d')
 	elif meta_file_granularity == 'monthly':
 		ds.coords["time"] = pd.date_range(
-			start=pd.Timestamp("{}-{}".format(years.start, months.start)),
-			end=pd.Timestamp("{}-{}".format(years.stop, months.stop)),
+			start=first_month_start,
+			end=month_start,
 			freq='MS')
 
 	ds = ds.stack(**{'year-month': ('year', 'month')})
@@ -302,7 +445,6 @@ def _prepare_gebco_height(xs, ys, gebco_fn=None):
 		from .config import gebco_path # pylint: disable=import-outside-toplevel
 		gebco_fn = gebco_path
 
-	tmpdir = tempfile.mkdtemp()
 	cornersc = np.array(((xs[0], ys[0]), (xs[-1], ys[-1])))
 	minc = np.minimum(*cornersc)
 	maxc = np.maximum(*cornersc)
@@ -310,25 +452,24 @@ def _prepare_gebco_height(xs, ys, gebco_fn=None):
 	minx, miny = minc - span/2.
 	maxx, maxy = maxc + span/2.
 
-	tmpfn = os.path.join(tmpdir, 'resampled.nc')
-	try:
-		ret = subprocess.call(['gdalwarp', '-of', 'NETCDF',
-							   '-ts', str(len(xs)), str(len(ys)),
-							   '-te', str(minx), str(miny), str(maxx), str(maxy),
-							   '-r', 'average',
-							   gebco_fn, tmpfn])
-		assert ret == 0, "gdalwarp was not able to resample gebco"
-	except OSError:
-		logger.warning("gdalwarp was not found for resampling gebco. "
-					   "Next-neighbour interpolation will be used instead!")
-		tmpfn = gebco_path #type: ignore
-
-	with xr.open_dataset(tmpfn) as ds_gebco:
-		height = (ds_gebco.rename({'lon': 'x', 'lat': 'y', 'Band1': 'height'})
-						  .reindex(x=xs, y=ys, method='nearest')
-						  .load()['height'])
-	shutil.rmtree(tmpdir)
-	return height
+	# Average gebco onto the (north-up) cutout grid in-process, using all cores for the warp
+	height = np.full((len(ys), len(xs)), np.nan, dtype=np.float32)
+	with ras.open(gebco_fn) as src:
+		crs = src.crs if src.crs is not None else 'EPSG:4326'
+		reproject(source=ras.band(src, 1),
+				  destination=height,
+				  src_crs=crs,
+				  dst_transform=from_bounds(minx, miny, maxx, maxy, len(xs), len(ys)),
+				  dst_crs=crs,
+				  dst_nodata=np.nan,
+				  resampling=Resampling.average,
+				  num_threads=os.cpu_count() or 1)
+
+	height = xr.DataArray(height,
+						  coords={'y': np.linspace(maxy - span[1]/2., miny + span[1]/2., len(ys)),
+								  'x': np.linspace(minx + span[0]/2., maxx - span[0]/2., len(xs))},
+						  dims=('y', 'x'), name='height')
+	return height.reindex(x=xs, y=ys, method='nearest')
 
 def _prepare_lat_direction(lat_direction, ys):
 	# Check direction of latitudes encoded in dataset, flip if necessary
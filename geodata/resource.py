@@ -28,7 +28,6 @@ from scipy.signal import fftconvolve
 from pkg_resources import resource_stream
 import numpy as np
 import yaml
-from six import string_types
 
 
 logger = logging.getLogger(name=__name__)
@@ -48,7 +47,7 @@ def get_solarpanelconfig(panel):
 def solarpanel_rated_capacity_per_unit(panel):
 	# unit is m^2 here
 
-	if isinstance(panel, string_types):
+	if isinstance(panel, str):
 		panel = get_solarpanelconfig(panel)
 
 	model = panel.get('model', 'huld')
@@ -61,7 +60,7 @@ def solarpanel_rated_capacity_per_unit(panel):
 		return (A + B * 1000. + C * np.log(1000.))*1e3
 
 def windturbine_rated_capacity_per_unit(turbine):
-	if isinstance(turbine, string_types):
+	if isinstance(turbine, str):
 		turbine = get_windturbineconfig(turbine)
 
 	return turbine['P']